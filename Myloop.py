@@ -1,12 +1,12 @@
+import contextlib
+import os
+import tempfile
+import threading
+from io import BytesIO
 import streamlit as st
-import osmnx as ox
-import networkx as nx
-import pandas as pd
+import numpy as np
 import folium
 from streamlit_folium import st_folium
-import xml.etree.ElementTree as ET
-from io import BytesIO
-from PIL import Image
 from streamlit_geolocation import streamlit_geolocation
 
 # -----------------------------
@@ -14,67 +14,238 @@ from streamlit_geolocation import streamlit_geolocation
 # -----------------------------
 st.set_page_config(page_title="🏃 Running Loop Generator", layout="centered")
 
-# Load Logo
-logo = Image.open("logo Myloop.webp")
+# osmnx (geopandas, shapely, pyproj...) takes about a second to import, so it
+# loads on a background thread while the page renders; routing code imports
+# it lazily and joins the thread before generating.
+def _warm_imports():
+    import osmnx  # noqa: F401
+    import scipy.sparse.csgraph  # noqa: F401
+    import scipy.spatial  # noqa: F401
+
+@st.cache_resource(show_spinner=False)
+def _import_warmer():
+    thread = threading.Thread(target=_warm_imports, daemon=True)
+    thread.start()
+    return thread
+
+_import_warmer()
+
+# Load Logo (decoded and scaled to its 200 px display width once per process)
+@st.cache_resource(show_spinner=False)
+def _load_logo():
+    from PIL import Image
+
+    logo = Image.open("logo Myloop.webp")
+    logo.thumbnail((200, 200))
+    return logo
+
 col1, col2, col3 = st.columns([1, 2, 1])
 with col2:
-    st.image(logo, width=200)
+    st.image(_load_logo(), width=200)
 
 st.title(":running: Running Loop Route Generator")
 
+# Overpass responses are cached in ./cache; downloaded graphs are also kept
+# as GraphML so nearby starts skip the download after a restart.
+OSM_CACHE_DIR = "./cache"
+GRAPH_CACHE_DIR = "graph_cache"
+# Least recently used files beyond this are deleted (~0.5-10 MB each)
+GRAPH_CACHE_MAX_FILES = 200
+
 # -----------------------------
 # Route Generation Functions
 # -----------------------------
-def generate_simple_loop(start_lat, start_lon, distance_km):
-    segment_km = distance_km / 4
-    east = (start_lat, start_lon + segment_km / 111)
-    north = (start_lat + segment_km / 111, east[1])
-    west = (north[0], start_lon)
+@st.cache_resource(max_entries=32, show_spinner=False)
+def _cached_graph(lat_r, lon_r, dist_m):
+    import osmnx as ox
+
+    ox.settings.use_cache = True
+    ox.settings.cache_folder = OSM_CACHE_DIR
+    path = os.path.join(GRAPH_CACHE_DIR, f"walk_{lat_r}_{lon_r}_{dist_m}.graphml")
+    if os.path.exists(path):
+        try:
+            G = ox.load_graphml(path)
+        except Exception:
+            # Unreadable file (e.g. left by a crash); drop it and download again.
+            # Another session may have removed it already.
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        else:
+            # Mark as recently used for eviction
+            with contextlib.suppress(OSError):
+                os.utime(path)
+            return G
+    G = ox.graph_from_point((lat_r, lon_r), dist=dist_m, network_type='walk', simplify=True)
+    # The file is only a cache, so a full or read-only disk must not fail the
+    # request. Write to a temp file and rename it into place, so a partial
+    # write never leaves a truncated GraphML under the final name.
+    tmp_path = None
+    try:
+        os.makedirs(GRAPH_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=GRAPH_CACHE_DIR, suffix=".graphml.tmp")
+        os.close(fd)
+        ox.save_graphml(G, tmp_path)
+        os.replace(tmp_path, path)
+        tmp_path = None
+        _evict_graph_files()
+    except OSError:
+        if tmp_path is not None:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+    return G
+
+def _evict_graph_files():
+    # Keep the GRAPH_CACHE_MAX_FILES most recently used graphs on disk
+    paths = [os.path.join(GRAPH_CACHE_DIR, f) for f in os.listdir(GRAPH_CACHE_DIR) if f.endswith(".graphml")]
+    if len(paths) <= GRAPH_CACHE_MAX_FILES:
+        return
+    paths.sort(key=os.path.getmtime)
+    for old_path in paths[:-GRAPH_CACHE_MAX_FILES]:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(old_path)
+
+def _routing_arrays(G):
+    # CSR adjacency, node coordinate arrays, component labels and a KD-tree
+    # built once per cached graph; parallel edges keep the shortest length
+    arrays = G.graph.get("_routing_arrays")
+    if arrays is None:
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.csgraph import connected_components
+        from scipy.spatial import cKDTree
+
+        nodes = list(G.nodes)
+        node_row = {n: i for i, n in enumerate(nodes)}
+        edges = [(node_row[u], node_row[v], length) for u, v, length in G.edges(data="length")]
+        u, v, w = (np.array(col) for col in zip(*edges))
+        order = np.lexsort((w, v, u))
+        u, v, w = u[order], v[order], w[order]
+        first = np.ones(len(u), dtype=bool)
+        first[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+        csr = csr_matrix((w[first], (u[first], v[first])), shape=(len(nodes), len(nodes)))
+        xs = np.fromiter((x for _, x in G.nodes(data="x")), dtype=np.float64, count=len(nodes))
+        ys = np.fromiter((y for _, y in G.nodes(data="y")), dtype=np.float64, count=len(nodes))
+        # Equirectangular scaling is exact enough for nearest-node snapping at
+        # the few-km scale of one graph
+        lon_scale = np.cos(np.radians(ys.mean()))
+        arrays = G.graph["_routing_arrays"] = {
+            "nodes": nodes,
+            "csr": csr,
+            "component": connected_components(csr, directed=True, connection="weak")[1],
+            "xs": xs,
+            "ys": ys,
+            "lon_scale": lon_scale,
+            "tree": cKDTree(np.column_stack((xs * lon_scale, ys))),
+        }
+    return arrays
 
-    G = ox.graph_from_point((start_lat, start_lon), dist=distance_km * 600, network_type='walk', simplify=True)
+def _fetch_graph(lat, lon, max_km):
+    # ~100 m quantization so nearby clicks share a cached graph. The fetch is a
+    # +/-dist bbox and the far corner sits max_km / 4 north and east of the
+    # start, so 300 m per km leaves ~20% slack; rounding up to 500 m buckets
+    # lets neighbouring slider values reuse the same graph.
+    dist_m = max(1500, int(np.ceil(max_km * 300 / 500)) * 500)
+    G = _cached_graph(round(lat, 3), round(lon, 3), dist_m)
+    if len(G.nodes) < 50:
+        raise RuntimeError("Not enough walkable streets around this start point.")
+    return G
 
-    start_node = ox.distance.nearest_nodes(G, start_lon, start_lat)
-    east_node = ox.distance.nearest_nodes(G, east[1], east[0])
-    north_node = ox.distance.nearest_nodes(G, north[1], north[0])
-    west_node = ox.distance.nearest_nodes(G, west[1], west[0])
+def _build_loop_on_graph(G, start_lat, start_lon, distance_km, max_km):
+    from scipy.sparse.csgraph import dijkstra
 
-    nodes_sequence = [start_node, east_node, north_node, west_node, start_node]
+    # Start, east, north-east and north corners of a square with sides of
+    # distance_km / 4; the longitude offset is divided by cos(lat) so the
+    # square has equal sides on the ground
+    d_lat = distance_km / 4 / 111
+    d_lon = d_lat / np.cos(np.radians(start_lat))
+    waypoints = np.array([start_lat, start_lon]) + np.array([[0, 0], [0, d_lon], [d_lat, d_lon], [d_lat, 0]])
 
-    route = []
+    arrays = _routing_arrays(G)
+    nodes, csr = arrays["nodes"], arrays["csr"]
+    _, waypoint_rows = arrays["tree"].query(np.column_stack((waypoints[:, 1] * arrays["lon_scale"], waypoints[:, 0])))
+    rows = [*waypoint_rows.tolist(), waypoint_rows[0]]
+
+    # Each leg is at least the straight line between its snapped nodes (111 km
+    # per degree slightly undershoots, keeping this a lower bound). A leg only
+    # fits a loop of at most max_km if the other three at their straight-line
+    # minimum leave room for it, so the sweeps stop at the largest such budget.
+    leg_xy = np.column_stack((arrays["xs"][rows] * arrays["lon_scale"], arrays["ys"][rows]))
+    straight_m = np.hypot(*np.diff(leg_xy, axis=0).T) * 111000
+    leg_limits = max_km * 1000 - (straight_m.sum() - straight_m)
+
+    # One C-level Dijkstra sweep per segment source, all in a single call
+    dist, pred = dijkstra(csr, indices=rows[:-1], return_predecessors=True, limit=max(leg_limits.max(), 0))
+
+    route_rows = []
     total_length = 0
-    for i in range(len(nodes_sequence) - 1):
-        try:
-            path = nx.shortest_path(G, nodes_sequence[i], nodes_sequence[i + 1], weight='length')
-            route.extend(path[:-1])
-            total_length += nx.path_weight(G, path, weight='length')
-        except Exception as e:
-            raise RuntimeError(f"Path error: {e}")
+    for i in range(len(rows) - 1):
+        src, tgt = rows[i], rows[i + 1]
+        if arrays["component"][src] != arrays["component"][tgt]:
+            raise RuntimeError(f"Path error: no walkable path from node {nodes[src]} to {nodes[tgt]}")
+        if dist[i, tgt] > leg_limits[i]:
+            raise RuntimeError(
+                f"Leg too long: no path from node {nodes[src]} to {nodes[tgt]} fits a {max_km:.2f} km loop"
+            )
+        segment = [tgt]
+        while segment[-1] != src:
+            segment.append(pred[i, segment[-1]])
+        route_rows.extend(reversed(segment[1:]))
+        total_length += dist[i, tgt]
 
-    route.append(start_node)
-    return G, route, total_length / 1000
+    route_rows.append(rows[0])
+    return np.array(route_rows), total_length / 1000
 
+@st.cache_data(ttl=3600, show_spinner=False)
 def find_best_loop(lat, lon, target_km, tolerance=0.15, max_attempts=10):
-    for i in range(max_attempts):
-        scale = 1 - (0.04 * i)
-        try_km = target_km * scale
-        try:
-            G, route, actual_km = generate_simple_loop(lat, lon, try_km)
-            if abs(actual_km - target_km) <= tolerance:
-                return G, route, actual_km
-        except Exception:
-            continue
-    return G, route, actual_km
-
-def export_gpx(route_df):
-    gpx = ET.Element("gpx", version="1.1", creator="MyLoopApp")
-    trk = ET.SubElement(gpx, "trk")
-    trkseg = ET.SubElement(trk, "trkseg")
-    for _, row in route_df.iterrows():
-        trkpt = ET.SubElement(trkseg, "trkpt", lat=str(row["lat"]), lon=str(row["lon"]))
-        ET.SubElement(trkpt, "ele").text = "0"
-    tree = ET.ElementTree(gpx)
+    # Attempts only ever shrink the loop, so one graph covers every retry
+    G = _fetch_graph(lat, lon, target_km)
+    # Bounded sweeps only find loops within tolerance; if none is, the
+    # attempts are repeated unbounded so the last loop found is still returned
+    for max_km in (target_km + tolerance, np.inf):
+        result = None
+        last_error = None
+        for i in range(max_attempts):
+            scale = 1 - (0.04 * i)
+            try_km = target_km * scale
+            try:
+                attempt = _build_loop_on_graph(G, lat, lon, try_km, max_km)
+            except Exception as e:
+                last_error = e
+                continue
+            result = attempt
+            if abs(result[1] - target_km) <= tolerance:
+                break
+        if result is not None and abs(result[1] - target_km) <= tolerance:
+            break
+    if result is None:
+        raise RuntimeError(f"Could not build a loop from this start point: {last_error}")
+    route_rows, actual_km = result
+    arrays = _routing_arrays(G)
+    return arrays["ys"][route_rows], arrays["xs"][route_rows], actual_km
+
+def _geodesic_preview_loop(lat, lon, distance_km, n=200):
+    # Circle of the requested circumference passing through the start point,
+    # no street network involved
+    r_deg = distance_km / (2 * np.pi) / 111
+    theta = np.linspace(-np.pi / 2, 1.5 * np.pi, n)
+    lats = lat + r_deg + r_deg * np.sin(theta)
+    lons = lon + r_deg * np.cos(theta) / np.cos(np.radians(lat))
+    return np.column_stack((lats, lons)).astype(np.float32)
+
+_GPX_HEADER = (
+    b"<?xml version='1.0' encoding='utf-8'?>\n"
+    b'<gpx version="1.1" creator="MyLoopApp"><trk><trkseg>'
+)
+_GPX_TRKPT = b'<trkpt lat="%.6f" lon="%.6f"><ele>0</ele></trkpt>'
+_GPX_FOOTER = b"</trkseg></trk></gpx>"
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def export_gpx(route_xy):
+    # Track points are formatted straight into the output buffer, with no
+    # intermediate element tree or joined string
     gpx_bytes = BytesIO()
-    tree.write(gpx_bytes, encoding="utf-8", xml_declaration=True)
+    gpx_bytes.write(_GPX_HEADER)
+    gpx_bytes.writelines(_GPX_TRKPT % tuple(point) for point in route_xy.tolist())
+    gpx_bytes.write(_GPX_FOOTER)
     return gpx_bytes.getvalue()
 
 # -----------------------------
@@ -83,14 +254,19 @@ def export_gpx(route_df):
 st.subheader("Step 1: Detect Your Location")
 location = streamlit_geolocation()
 
+# Only move the map when a new fix arrives, so ordinary reruns keep the same
+# center and zoom instead of resetting them
 if location['latitude'] is not None:
-    st.session_state.map_center = [location["latitude"], location["longitude"]]
-    st.session_state.map_zoom = 15
-    st.session_state.location_detected = True
+    detected_center = [location["latitude"], location["longitude"]]
+    if st.session_state.get("map_center") != detected_center:
+        st.session_state.map_center = detected_center
+        st.session_state.map_zoom = 15
+        st.session_state.location_detected = True
     st.success("Location detected. Scroll down to select a start point or use your current one.")
 else:
-    st.session_state.map_center = [24.7136, 46.6753]  # Riyadh fallback
-    st.session_state.map_zoom = 13
+    if "map_center" not in st.session_state:
+        st.session_state.map_center = [24.7136, 46.6753]  # Riyadh fallback
+        st.session_state.map_zoom = 13
     st.warning("Couldn't detect location automatically. You can click on the map to select a start point.")
 
 # -----------------------------
@@ -102,8 +278,10 @@ if "map_zoom" not in st.session_state:
     st.session_state.map_zoom = 13
 if "latlon" not in st.session_state:
     st.session_state.latlon = None
-if "route_df" not in st.session_state:
-    st.session_state.route_df = None
+if "route_xy" not in st.session_state:
+    st.session_state.route_xy = None
+if "route_is_preview" not in st.session_state:
+    st.session_state.route_is_preview = False
 
 m = folium.Map(location=st.session_state.map_center, zoom_start=st.session_state.map_zoom)
 
@@ -125,24 +303,26 @@ if st.session_state.latlon:
         icon=folium.Icon(color="green", icon="map-marker")
     ).add_to(m)
 
-if st.session_state.route_df is not None:
+if st.session_state.route_xy is not None:
+    route_xy = st.session_state.route_xy
+    generated_km = st.session_state.generated_km
+    distance_label = f"{generated_km:.2f} km" + (" (preview)" if st.session_state.route_is_preview else "")
     folium.PolyLine(
-        locations=st.session_state.route_df[["lat", "lon"]].values.tolist(),
+        locations=np.round(route_xy.astype(np.float64), 6).tolist(),
         color="blue",
         weight=5
     ).add_to(m)
 
-    mid_idx = len(st.session_state.route_df) // 2
-    mid_point = st.session_state.route_df.iloc[mid_idx]
-    offset_lat = mid_point["lat"] + 0.0005
-    offset_lon = mid_point["lon"] + 0.0005
+    mid_lat, mid_lon = route_xy[len(route_xy) // 2].tolist()
+    offset_lat = mid_lat + 0.0005
+    offset_lon = mid_lon + 0.0005
 
     folium.Marker(
         location=[offset_lat, offset_lon],
-        popup=f"Distance: {st.session_state.generated_km:.2f} km",
+        popup=f"Distance: {distance_label}",
         icon=folium.DivIcon(html=f"""
             <div style='font-size: 14pt; color: black; background-color: white; padding: 2px; border-radius: 5px;'>
-                {st.session_state.generated_km:.2f} km
+                {distance_label}
             </div>
         """)
     ).add_to(m)
@@ -152,10 +332,11 @@ click_result = st_folium(m, height=500, returned_objects=["last_clicked"], key="
 if click_result and click_result.get("last_clicked"):
     lat = click_result["last_clicked"]["lat"]
     lon = click_result["last_clicked"]["lng"]
-    st.session_state.latlon = (lat, lon)
+    # ~10 m grid so re-clicks near the same spot hit the route cache
+    st.session_state.latlon = (round(lat, 4), round(lon, 4))
 
 if st.session_state.latlon is None and st.session_state.get("location_detected"):
-    st.session_state.latlon = tuple(st.session_state.map_center)
+    st.session_state.latlon = tuple(round(v, 4) for v in st.session_state.map_center)
 
 # -----------------------------
 # Step 3: Choose Distance and Generate Route
@@ -166,24 +347,36 @@ if st.session_state.latlon:
     distance_km = st.slider("Choose Loop Distance (km)", 1.0, 15.0, 5.0, 0.5)
 
     if st.button("Generate Running Loop"):
+        _import_warmer().join()
         try:
-            G, route, actual_distance_km = find_best_loop(lat, lon, distance_km)
-            coords = [(G.nodes[n]['y'], G.nodes[n]['x']) for n in route]
-            route_df = pd.DataFrame(coords, columns=["lat", "lon"])
-            st.session_state.route_df = route_df
+            lats, lons, actual_distance_km = find_best_loop(lat, lon, distance_km)
+            # (N, 2) lat/lon; float32 still resolves well under a metre
+            st.session_state.route_xy = np.column_stack((lats, lons)).astype(np.float32)
             st.session_state.generated_km = actual_distance_km
+            st.session_state.route_is_preview = False
             st.rerun()
         except Exception as e:
             st.error(f"Error: {e}")
 
+    if st.button("Quick Preview (ignores streets)"):
+        st.session_state.route_xy = _geodesic_preview_loop(lat, lon, distance_km)
+        st.session_state.generated_km = distance_km
+        st.session_state.route_is_preview = True
+        st.rerun()
+
 # -----------------------------
 # Step 4: Download + Komoot Instructions
 # -----------------------------
-if st.session_state.route_df is not None:
-    gpx_data = export_gpx(st.session_state.route_df)
-    file_name = "running_loop.gpx"
+if st.session_state.route_xy is not None:
+    gpx_data = export_gpx(st.session_state.route_xy)
+    file_name = "loop_preview.gpx" if st.session_state.route_is_preview else "running_loop.gpx"
 
     st.subheader("Step 4: Download and Use in Komoot")
+    if st.session_state.route_is_preview:
+        st.warning(
+            "This is a Quick Preview circle that ignores streets; its distance is the "
+            "target, not a measured route. Generate a running loop for a route you can follow."
+        )
     download_clicked = st.download_button(
         label="Download GPX File",
         data=gpx_data,